@@ -173,13 +173,15 @@ class Etheno(object):
         return None
             
     def post(self, data):
-        self.logger.debug(f"Handling JSON RPC request {data}")
+        if self.logger.isEnabledFor(logger.DEBUG):
+            self.logger.debug(f"Handling JSON RPC request {data}")
 
         for plugin in self.plugins:
             try:
                 new_data = plugin.before_post(dict(data))
                 if new_data is not None and new_data != data:
-                    self.logger.debug(f"Incoming JSON RPC request {data} changed by plugin {plugin!r} to {new_data}")
+                    if self.logger.isEnabledFor(logger.DEBUG):
+                        self.logger.debug(f"Incoming JSON RPC request {data} changed by plugin {plugin!r} to {new_data}")
                     data = new_data
             except DropPost:
                 self.logger.info(f"Incoming JSON RPC request {data} dropped by plugin {plugin!r}")
@@ -214,7 +216,8 @@ class Etheno(object):
                     ret = e
     
         self.rpc_client_result = ret
-        self.logger.debug(f"Result from the master client ({self.master_client}): {ret}")
+        if self.logger.isEnabledFor(logger.DEBUG):
+            self.logger.debug(f"Result from the master client ({self.master_client}): {ret}")
 
         results = []
 
@@ -240,7 +243,8 @@ class Etheno(object):
             except JSONRPCError as e:
                 self.logger.error(e)
                 results.append(e)
-            self.logger.debug(f"Result from client {client}: {results[-1]}")
+            if self.logger.isEnabledFor(logger.DEBUG):
+                self.logger.debug(f"Result from client {client}: {results[-1]}")
 
         if ret is None:
             return None
@@ -371,7 +375,8 @@ class EthenoView(MethodView):
 
         ret = ETHENO.post(data)
 
-        ETHENO.logger.debug(f"Returning {ret}")
+        if ETHENO.logger.isEnabledFor(logger.DEBUG):
+            ETHENO.logger.debug(f"Returning {ret}")
 
         if ret is None:
             return None
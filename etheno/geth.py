@@ -8,19 +8,16 @@ from .client import JSONRPCError
 from .jsonrpcclient import JSONRPCClient
 from .utils import format_hex_address
 
+_ANSI_PREFIXES = (logger.ANSI_RESET, logger.ANSI_BOLD) \
+    + tuple(logger.ANSI_COLOR % (30 + color.value) for color in logger.CGAColors) \
+    + tuple(f"\033[{30 + color.value}m" for color in logger.CGAColors)
+
 def ltrim_ansi(text):
-    if text.startswith(logger.ANSI_RESET):
-        return ltrim_ansi(text[len(logger.ANSI_RESET):])
-    elif text.startswith(logger.ANSI_BOLD):
-        return ltrim_ansi(text[len(logger.ANSI_BOLD):])
-    for color in logger.CGAColors:
-        ansi = logger.ANSI_COLOR % (30 + color.value)
-        if text.startswith(ansi):
-            return ltrim_ansi(text[len(ansi):])
-    for color in logger.CGAColors:
-        ansi = f"\033[{30 + color.value}m"
-        if text.startswith(ansi):
-            return ltrim_ansi(text[len(ansi):])
+    while text.startswith(_ANSI_PREFIXES):
+        for ansi in _ANSI_PREFIXES:
+            if text.startswith(ansi):
+                text = text[len(ansi):]
+                break
     return text
 
 class GethClient(JSONRPCClient):
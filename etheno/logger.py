@@ -1,9 +1,16 @@
+import atexit
+import copy
 import enum
+import gzip
 import logging
+import logging.handlers
 import os
+import queue
+import re
+import selectors
+import shutil
 import tempfile
 import threading
-import time
 
 import ptyprocess
 
@@ -21,6 +28,9 @@ ANSI_RESET = "\033[0m"
 ANSI_COLOR = "\033[1;%dm"
 ANSI_BOLD  = "\033[1m"
 
+# iterating an Enum is much slower than iterating a tuple, so resolve the color escape sequences once
+_COLOR_SUBS = tuple(("$%s" % color.name, ANSI_COLOR % (30 + color.value)) for color in CGAColors)
+
 LEVEL_COLORS = {
     CRITICAL: CGAColors.MAGENTA,
     ERROR: CGAColors.RED,
@@ -31,8 +41,10 @@ LEVEL_COLORS = {
 }
 
 def formatter_message(message, use_color = True):
+    if '$' not in message:
+        return message
     if use_color:
-        message = message.replace("$RESET", RESET_SEQ).replace("$BOLD", BOLD_SEQ)
+        message = message.replace("$RESET", ANSI_RESET).replace("$BOLD", ANSI_BOLD)
     else:
         message = message.replace("$RESET", "").replace("$BOLD", "")
     return message
@@ -49,39 +61,223 @@ class ComposableFormatter(object):
         return getattr(self._parent_formatter, name)
 
 class ColorFormatter(ComposableFormatter):
+    _SUBS = dict(_COLOR_SUBS + (
+        ('$RESET', ANSI_RESET),
+        ('$BOLD', ANSI_BOLD)
+    ))
+    _PATTERN = re.compile('|'.join(re.escape(k) for k in sorted(_SUBS, key=len, reverse=True)))
+    _STRIP_KEYS = tuple(_SUBS) + ('$LEVELCOLOR',)
+    _STRIP_PATTERN = re.compile('|'.join(re.escape(k) for k in sorted(_STRIP_KEYS, key=len, reverse=True)))
+    _FIELD_PATTERN = re.compile(r'%\((\w+)\)')
+    _LEVELNAME_PATTERN = re.compile(r'%\(levelname\)([-#0 +]*\d*(?:\.\d+)?[sr])')
+    _DATEFMT_CODE_PATTERN = re.compile(r'%(.)')
+    _DATEFMT_FIELDS = {
+        'Y': ('%04d', 'tm_year'),
+        'm': ('%02d', 'tm_mon'),
+        'd': ('%02d', 'tm_mday'),
+        'H': ('%02d', 'tm_hour'),
+        'M': ('%02d', 'tm_min'),
+        'S': ('%02d', 'tm_sec')
+    }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        first_newline = self.reformat('$RESET $BOLD$BLUE\\$RESET\n')
+        other_newlines = self.reformat('\n$RESET$BOLD$BLUE> $RESET')
+        self._level_subs = {
+            level: (ANSI_COLOR % (30 + color.value), first_newline, other_newlines)
+            for level, color in LEVEL_COLORS.items()
+        }
+        self._prefix_by_level = self._build_prefixes()
+        self._datefmt_template, self._datefmt_fields = self._compile_datefmt(self._parent_formatter.datefmt)
+        self._last_asctime = (None, None)
+    def _compile_datefmt(self, datefmt):
+        '''Splits `datefmt` into a %-template of its literal text (including any ANSI escapes) and the `time.struct_time`
+        fields to interpolate into it. Returns `(None, None)` if `datefmt` uses a code we do not handle.'''
+        if datefmt is None:
+            return None, None
+        template = []
+        fields = []
+        pos = 0
+        for m in self._DATEFMT_CODE_PATTERN.finditer(datefmt):
+            if m.group(1) not in self._DATEFMT_FIELDS:
+                return None, None
+            conversion, field = self._DATEFMT_FIELDS[m.group(1)]
+            template.append(datefmt[pos:m.start()].replace('%', '%%'))
+            template.append(conversion)
+            fields.append(field)
+            pos = m.end()
+        template.append(datefmt[pos:].replace('%', '%%'))
+        return ''.join(template), tuple(fields)
+    def formatTime(self, record, datefmt=None):
+        parent = self._parent_formatter
+        if self._datefmt_template is None or datefmt != parent.datefmt:
+            return parent.formatTime(record, datefmt)
+        # the formatted time only changes once per second, so reuse the last one
+        second = int(record.created)
+        last_second, asctime = self._last_asctime
+        if second != last_second:
+            tm = parent.converter(record.created)
+            asctime = self._datefmt_template % tuple(getattr(tm, field) for field in self._datefmt_fields)
+            self._last_asctime = (second, asctime)
+        return asctime
+    def _build_prefixes(self):
+        '''Resolves the level name and color of the parent format once per level, leaving only `asctime` and `message`
+        to be interpolated per record. Returns an empty dict if the parent format has any other fields.'''
+        parent = self._parent_formatter
+        if not isinstance(getattr(parent, '_style', None), logging.PercentStyle):
+            return {}
+        fmt = parent._fmt
+        if not set(self._FIELD_PATTERN.findall(fmt)) <= {'levelname', 'asctime', 'message'}:
+            return {}
+        return {
+            level: self._LEVELNAME_PATTERN.sub(
+                lambda m: ('%' + m.group(1)) % logging.getLevelName(level), fmt
+            ).replace('$LEVELCOLOR', levelcolor)
+            for level, (levelcolor, _, _) in self._level_subs.items()
+        }
     def reformat(self, fmt):
-        for color in CGAColors:
-            fmt = fmt.replace("$%s" % color.name, ANSI_COLOR % (30 + color.value))
-        fmt = fmt.replace('$RESET', ANSI_RESET)
-        fmt = fmt.replace('$BOLD', ANSI_BOLD)
-        return fmt
+        if '$' not in fmt:
+            return fmt
+        return self._PATTERN.sub(lambda m: self._SUBS[m.group(0)], fmt)
     @staticmethod
     def remove_color(fmt):
-        for color in CGAColors:
-            fmt = fmt.replace("$%s" % color.name, '')
-        fmt = fmt.replace('$RESET', '')
-        fmt = fmt.replace('$BOLD', '')
-        fmt = fmt.replace('$LEVELCOLOR', '')
-        return fmt
+        if '$' not in fmt:
+            return fmt
+        return ColorFormatter._STRIP_PATTERN.sub('', fmt)
     def new_formatter(self, fmt, *args, **kwargs):
         if 'datefmt' in kwargs:
             kwargs['datefmt'] = self.reformat(kwargs['datefmt'])
         return super().new_formatter(self.reformat(fmt), *args, **kwargs)
     def format(self, *args, **kwargs):
-        levelcolor = LEVEL_COLORS.get(args[0].levelno, LEVEL_COLORS[NOTSET])
+        record = args[0]
+        prefix = self._prefix_by_level.get(record.levelno)
+        if prefix is not None and len(args) == 1 and not kwargs and not record.exc_info and not record.exc_text \
+                and not record.stack_info:
+            record.message = record.getMessage()
+            if '\n' not in record.message:
+                record.asctime = self.formatTime(record, self._parent_formatter.datefmt)
+                return prefix % {'asctime': record.asctime, 'message': record.message}
+        levelcolor, first_newline, other_newlines = self._level_subs.get(args[0].levelno, self._level_subs[NOTSET])
         ret = self._parent_formatter.format(*args, **kwargs)
-        ret = ret.replace('$LEVELCOLOR', ANSI_COLOR % (30 + levelcolor.value))
-        ret = ret.replace('\n', self.reformat('$RESET $BOLD$BLUE\\$RESET\n'), 1)
-        ret = ret.replace('\n', self.reformat('\n$RESET$BOLD$BLUE> $RESET'))
+        ret = ret.replace('$LEVELCOLOR', levelcolor)
+        if '\n' in ret:
+            ret = ret.replace('\n', first_newline, 1)
+            ret = ret.replace('\n', other_newlines)
         return ret
 
 class NonInfoFormatter(ComposableFormatter):
     _vanilla_formatter = logging.Formatter()
-    def format(self, *args, **kwargs):
-        if args and args[0].levelno == INFO:
-            return self._vanilla_formatter.format(*args, **kwargs)
-        else:
-            return self._parent_formatter.format(*args, **kwargs)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._dispatch = {INFO: self._vanilla_formatter.format}
+        self._default_format = self._parent_formatter.format
+    def format(self, record, *args, **kwargs):
+        return self._dispatch.get(record.levelno, self._default_format)(record, *args, **kwargs)
+
+class _RecordQueueHandler(logging.handlers.QueueHandler):
+    '''Enqueues records for the shared listener, tagged with the EthenoLogger whose handlers should emit them'''
+    def __init__(self, etheno_logger):
+        super().__init__(_LOG_QUEUE)
+        self.etheno_logger = etheno_logger
+    def prepare(self, record):
+        # Resolve the message and any traceback here, on the logging thread: the arguments may be mutated (or the
+        # exception gone) by the time the listener gets to the record. This also means that `msg % args` runs only
+        # once, rather than once per handler the record is emitted to. Work on a copy: the caller's record may still
+        # be propagated to other stdlib handlers on this thread while the listener emits ours.
+        record = copy.copy(record)
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                if not record.exc_text:
+                    record.exc_text = _EXC_FORMATTER.formatException(record.exc_info)
+                record.exc_info = None
+        except Exception:
+            # leave the record untouched so that each handler reports the error through `handleError`
+            pass
+        return self.etheno_logger, record
+
+class _EthenoLoggerListener(logging.handlers.QueueListener):
+    '''A single QueueListener that emits the records of every EthenoLogger, in the order they were logged'''
+    def handle(self, item):
+        if isinstance(item, threading.Event):
+            # a flush marker from `_flush_log_queue`
+            item.set()
+            return
+        etheno_logger, record = item
+        for handler in etheno_logger._handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+_LOG_QUEUE = queue.Queue()
+_EXC_FORMATTER = logging.Formatter()
+_LOG_LISTENER = None
+_LOG_LISTENER_STOPPED = False
+# guards starting and stopping the listener, so that nothing is enqueued for it after its stop sentinel
+_LOG_LISTENER_LOCK = threading.Lock()
+_LOG_FLUSH_TIMEOUT = 5.0
+
+def _start_log_listener():
+    global _LOG_LISTENER
+    with _LOG_LISTENER_LOCK:
+        if _LOG_LISTENER is None and not _LOG_LISTENER_STOPPED:
+            _LOG_LISTENER = _EthenoLoggerListener(_LOG_QUEUE)
+            _LOG_LISTENER.start()
+            atexit.register(_stop_log_listener)
+
+def _flush_log_queue(timeout=_LOG_FLUSH_TIMEOUT):
+    '''Blocks until every record enqueued so far has been emitted, or until `timeout` seconds have passed'''
+    with _LOG_LISTENER_LOCK:
+        if _LOG_LISTENER is None or _LOG_LISTENER_STOPPED:
+            return
+        flushed = threading.Event()
+        _LOG_QUEUE.put(flushed)
+    # bounded, in case the listener thread has died
+    flushed.wait(timeout)
+
+def _stop_log_listener():
+    '''Flushes any queued records and switches every EthenoLogger over to emitting synchronously'''
+    global _LOG_LISTENER, _LOG_LISTENER_STOPPED
+    with _LOG_LISTENER_LOCK:
+        _LOG_LISTENER_STOPPED = True
+        listener = _LOG_LISTENER
+        _LOG_LISTENER = None
+    if listener is None:
+        return
+    listener.stop()
+    for etheno_logger in list(ETHENO_LOGGERS.values()):
+        etheno_logger._emit_synchronously()
+    # emit anything that was enqueued after the stop sentinel but before the switch above
+    while True:
+        try:
+            listener.handle(_LOG_QUEUE.get_nowait())
+        except queue.Empty:
+            break
+
+class GzipRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    '''A RotatingFileHandler that gzip-compresses each log file as it is rolled over'''
+    def __init__(self, filename, maxBytes=128 << 20, backupCount=10, **kwargs):
+        super().__init__(filename, maxBytes=maxBytes, backupCount=backupCount, **kwargs)
+        # only rotate regular files (not, e.g., `--log-file /dev/stderr`)
+        self._rotatable = os.path.isfile(self.baseFilename)
+    def shouldRollover(self, record):
+        # Unlike the superclass, don't format every record an extra time just to measure it;
+        # rolling over once the file has reached `maxBytes` is close enough.
+        if not self._rotatable or self.maxBytes <= 0:
+            return False
+        if self.stream is None:
+            self.stream = self._open()
+        return self.stream.tell() >= self.maxBytes
+    def rotation_filename(self, default_name):
+        return default_name + '.gz'
+    def rotate(self, source, dest):
+        with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+def _open_exclusive(path, flags):
+    return os.open(path, flags | os.O_CREAT | os.O_EXCL, 0o666)
 
 ETHENO_LOGGERS = {}
 
@@ -118,13 +314,36 @@ class EthenoLogger(object):
             self.displayname = name
         else:
             self.displayname = displayname
+        if parent is not None and parent.parent is not None:
+            self._name_prefix = parent._name_prefix
+        else:
+            self._name_prefix = ''
+        self._name_prefix += "[$RESET$WHITE%s$BLUE$BOLD]" % self.displayname
         if log_level is None:
             if parent is None:
                 raise ValueError('A logger must be provided a parent if `log_level` is None')
             log_level = parent.log_level
         self._log_level = log_level
         self._logger = _LOGGING_GETLOGGER(name)
+        # bind the per-record methods directly so that calls to them do not go through `__getattr__`
+        self.debug = self._logger.debug
+        self.info = self._logger.info
+        self.warning = self._logger.warning
+        self.error = self._logger.error
+        self.critical = self._logger.critical
+        self.exception = self._logger.exception
+        self.log = self._logger.log
+        self.isEnabledFor = self._logger.isEnabledFor
         self._handlers = [logging.StreamHandler()]
+        # Formatting and handler I/O happen on the shared listener's thread; the logging thread only enqueues records
+        _start_log_listener()
+        if _LOG_LISTENER is None:
+            # the listener has already been shut down at exit
+            self._queue_handler = None
+            self._logger.addHandler(self._handlers[0])
+        else:
+            self._queue_handler = _RecordQueueHandler(self)
+            self._logger.addHandler(self._queue_handler)
         if log_level is not None:
             self.log_level = log_level
         formatter = ColorFormatter(self.DEFAULT_FORMAT.replace('$NAME', self._name_format()), datefmt='%m$BLUE-$WHITE%d$BLUE|$WHITE%H$BLUE:$WHITE%M$BLUE:$WHITE%S')
@@ -133,12 +352,23 @@ class EthenoLogger(object):
         else:
             parent._add_child(self)
         self._handlers[0].setFormatter(formatter)
-        self._logger.addHandler(self._handlers[0])
         self._tmpdir = None
+        self._logged_file_indices = {}
         
+    def _emit_synchronously(self):
+        '''Attaches this logger's handlers directly to its stdlib logger, bypassing the shared queue'''
+        if self._queue_handler is None:
+            return
+        self._logger.removeHandler(self._queue_handler)
+        self._queue_handler = None
+        for handler in self._handlers:
+            self._logger.addHandler(handler)
+
     def close(self):
         for child in self.children:
             child.close()
+        # make sure that everything logged so far has been written (and, e.g., is counted when checking for empty files)
+        _flush_log_queue()
         if self.cleanup_empty:
             # first, check any files that handlers have created:
             for h in self._handlers:
@@ -150,9 +380,26 @@ class EthenoLogger(object):
                             os.remove(log_path)
             # next, check if the output directory can be cleaned up
             if self.directory:
-                for dirpath, dirnames, filenames in os.walk(self.directory, topdown=False):
-                    if len(dirnames) == 0 and len(filenames) == 0 and dirpath != self.directory:
-                        os.rmdir(dirpath)
+                def prune(path):
+                    '''Removes all empty directories below `path`; returns whether `path` itself is now empty'''
+                    empty = True
+                    try:
+                        with os.scandir(path) as it:
+                            entries = list(it)
+                    except OSError:
+                        # e.g., the directory has already been removed, or it is not readable
+                        return False
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False) and prune(entry.path):
+                            try:
+                                os.rmdir(entry.path)
+                                continue
+                            except OSError:
+                                # e.g., something was written to it in the meantime, or it is not writable
+                                pass
+                        empty = False
+                    return empty
+                prune(self.directory)
         if self._tmpdir is not None:
             self._tmpdir.cleanup()
             self._tmpdir = None
@@ -170,25 +417,28 @@ class EthenoLogger(object):
         else:
             child._tmpdir = tempfile.TemporaryDirectory()
             child.save_to_directory(child._tmpdir.name)
+        # attach each handler inherited from this logger and its ancestors exactly once
+        added = set()
         parent = self
         while parent is not None:
-            for handler in self._descendant_handlers:
-                child.addHandler(handler, include_descendants=True)
+            for handler in parent._descendant_handlers:
+                if id(handler) not in added:
+                    added.add(id(handler))
+                    child.addHandler(handler, include_descendants=True)
             parent = parent.parent
 
     def _name_format(self):
-        if self.parent is not None and self.parent.parent is not None:
-            ret = self.parent._name_format()
-        else:
-            ret = ''
-        return ret + "[$RESET$WHITE%s$BLUE$BOLD]" % self.displayname
+        return self._name_prefix
 
     def addHandler(self, handler, include_descendants=True, set_log_level=True):
         if set_log_level:
             handler.setLevel(self.log_level)
-        self._logger.addHandler(handler)
-        self._handlers.append(handler)
-        if include_descendants:
+        # like `logging.Logger.addHandler`, never register the same handler twice
+        if handler not in self._handlers:
+            if self._queue_handler is None:
+                self._logger.addHandler(handler)
+            self._handlers.append(handler)
+        if include_descendants and handler not in self._descendant_handlers:
             self._descendant_handlers.append(handler)
             for child in self.children:
                 if isinstance(child, EthenoLogger):
@@ -201,18 +451,25 @@ class EthenoLogger(object):
         if dir is None:
             dir = ''
         else:
-            dir = os.path.relpath(os.path.realpath(dir), start=os.path.realpath(self.directory))
+            dir = os.path.relpath(os.path.realpath(dir), start=self.directory)
         os.makedirs(os.path.join(self.directory, dir), exist_ok=True)
-        i = 1
+        # start counting from the last index handed out for this naming scheme rather than re-probing from 1
+        key = (prefix, suffix, dir)
+        i = self._logged_file_indices.get(key, 1)
         while True:
             if i == 1:
                 filename = f"{prefix}{suffix}"
             else:
                 filename = f"{prefix}{i}{suffix}"
             path = os.path.join(self.directory, dir, filename)
-            if not os.path.exists(path):
-                return open(path, mode)
-            i += 1
+            try:
+                # O_EXCL makes the existence check and the creation a single atomic open
+                f = open(path, mode, opener=_open_exclusive)
+            except FileExistsError:
+                i += 1
+                continue
+            self._logged_file_indices[key] = i + 1
+            return f
 
     def make_constant_logged_file(self, contents, *args, **kwargs):
         '''Creates a logged file, populates it with the provided contents, and returns the absolute path to the file.'''
@@ -225,14 +482,13 @@ class EthenoLogger(object):
     def to_log_path(self, absolute_path):
         if self.directory is None:
             return absolute_path
-        absolute_path = os.path.realpath(absolute_path)
-        dirpath = os.path.realpath(self.directory)
-        return os.path.relpath(absolute_path, start=dirpath)
+        # `self.directory` was already resolved by `save_to_directory`
+        return os.path.relpath(os.path.realpath(absolute_path), start=self.directory)
 
     def save_to_file(self, path, include_descendants=True, log_level=None):
         if log_level is None:
             log_level = self.log_level
-        handler = logging.FileHandler(path)
+        handler = GzipRotatingFileHandler(path)
         handler.setLevel(log_level)
         handler.setFormatter(logging.Formatter(ColorFormatter.remove_color(self.DEFAULT_FORMAT.replace('$NAME', self._name_format())), datefmt='%m-%d|%H:%M:%S'))
         self.addHandler(handler, include_descendants=include_descendants, set_log_level=False)
@@ -287,38 +543,54 @@ class StreamLogger(threading.Thread):
         if isinstance(newline_char, str):
             newline_char = newline_char.encode('utf-8')
         self._newline_char = newline_char
-        self._buffers = [b'' for i in range(len(streams))]
+        self._buffers = [bytearray() for i in range(len(streams))]
         self._done = False
         self.log = lambda logger, message : logger.info(message)
     def is_done(self):
         return self._done
+    def _emit_lines(self, buffer):
+        # Split all of the complete lines read in one pass at once, but still emit one record per line so that every
+        # line in the log files gets its own prefix (and single-line records take `ColorFormatter`'s fast path)
+        idx = buffer.rfind(self._newline_char)
+        if idx < 0:
+            return
+        lines = bytes(buffer[:idx]).split(self._newline_char)
+        del buffer[:idx + len(self._newline_char)]
+        for line in lines:
+            # don't let an undecodable byte stop us from reading the rest of the output
+            try:
+                self.log(self.logger, line.decode(errors='replace'))
+            except Exception:
+                # A failing `self.log` (e.g., a client's custom override) must not stop us from reading: if
+                # nobody drains the pipes, the process blocks as soon as their buffers fill up.
+                pass
     def run(self):
-        while not self.is_done():
-            while True:
-                got_byte = False
-                try:
-                    for i, stream in enumerate(self.streams):
-                        byte = stream.read(1)
-                        while byte is not None and len(byte):
-                            if isinstance(byte, str):
-                                byte = byte.encode('utf-8')
-                            if byte == self._newline_char:
-                                self.log(self.logger, self._buffers[i].decode())
-                                self._buffers[i] = b''
-                            else:
-                                self._buffers[i] += byte
-                            got_byte = True
-                            byte = stream.read(1)
-                except Exception:
-                    self._done = True
-                if not got_byte or self._done:
+        with selectors.DefaultSelector() as selector:
+            for stream, buffer in zip(self.streams, self._buffers):
+                selector.register(stream.fileno(), selectors.EVENT_READ, buffer)
+            while selector.get_map():
+                events = selector.select(timeout=0.5)
+                if not events and self.is_done():
+                    # keep draining output written before the process exited until there is none left
                     break
-            time.sleep(0.5)
+                for key, _ in events:
+                    try:
+                        data = os.read(key.fd, 65536)
+                    except OSError:
+                        # a pty raises EIO once its child has exited
+                        data = b''
+                    if not data:
+                        selector.unregister(key.fd)
+                        continue
+                    key.data.extend(data)
+                    self._emit_lines(key.data)
 
 class ProcessLogger(StreamLogger):
     def __init__(self, logger, process):
         self.process = process
-        super().__init__(logger, open(process.stdout.fileno(), buffering=1), open(process.stderr.fileno(), buffering=1))
+        # the pipes are read directly by fd, so there is no need to wrap them; skip any that were not captured
+        # (e.g., when the process was started with `stderr=subprocess.STDOUT`)
+        super().__init__(logger, *(stream for stream in (process.stdout, process.stderr) if stream is not None))
     def is_done(self):
         return self.process.poll() is not None
 